@@ -1,3 +1,4 @@
+from .locations_asy import create_async_app as create_async_locations_app
 from .locations_cli import locations_cli_blueprint
 from .locations_db import Region, Municipality, Settlement, Place
 from .locations_ini import init_locations
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+from asyncio import gather
+from collections import OrderedDict
+from datetime import datetime, timezone
+from json import dumps
+from re import compile as compile_regex
+from time import monotonic
+from typing import Generator
+from urllib.parse import parse_qs
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import joinedload
+from werkzeug.http import http_date, parse_date
+
+from .locations_db import Place, County, Region, Settlement, canonicalize
+from .locations_exp import dump_models
+from .locations_ini import LocationsConfig, prepare_datetime, cache_counters, CacheCounter
+
+PLACE_LOAD_OPTIONS = (joinedload(Place.reg), joinedload(Place.mun),
+                      joinedload(Place.settlement).joinedload(Settlement.type), joinedload(Place.type))
+REGION_PATH = compile_regex(r"^/regions/(\d+)/settlements/$")
+
+
+class AsyncMemoryCache:
+    """LRU cache with expiry, defaults match flask_caching's SimpleCache"""
+
+    def __init__(self, threshold: int = 500, default_timeout: float = 300):
+        self.data: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.threshold = threshold
+        self.default_timeout = default_timeout
+
+    async def get(self, key: str) -> bytes | None:
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < monotonic():
+            del self.data[key]
+            return None
+        self.data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: bytes):
+        self.data[key] = monotonic() + self.default_timeout, value
+        self.data.move_to_end(key)
+        while len(self.data) > self.threshold:
+            self.data.popitem(last=False)
+
+    async def clear(self):
+        self.data.clear()
+
+
+class AsyncRedisCache:
+    def __init__(self, url: str, key_prefix: str = "nq-locations-", timeout: int = None):
+        from redis.asyncio import Redis  # optional dependency, only needed for this cache
+
+        self.client = Redis.from_url(url)
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.client.get(self.key_prefix + key)
+
+    async def set(self, key: str, value: bytes):
+        await self.client.set(self.key_prefix + key, value, ex=self.timeout)
+
+    async def clear(self):
+        async for key in self.client.scan_iter(match=self.key_prefix + "*"):
+            await self.client.delete(key)
+
+
+class SyncSessionAdapter:
+    def __init__(self, session):
+        self.session = session
+
+    def get_first(self, stmt):
+        return self.session.scalars(stmt).first()
+
+    def get_all(self, stmt):
+        return self.session.scalars(stmt).all()
+
+
+class AsyncLocationsSearcher:
+    def __init__(self, sessionmaker: async_sessionmaker):
+        self.sessionmaker = sessionmaker
+
+    async def scalars(self, stmt) -> list:
+        async with self.sessionmaker() as session:
+            return list(await session.scalars(stmt))
+
+    async def get_first(self, stmt):
+        async with self.sessionmaker() as session:
+            return (await session.scalars(stmt)).first()
+
+    async def get_places(self, stmt) -> list[Place]:
+        return await self.scalars(stmt.options(*PLACE_LOAD_OPTIONS))
+
+    async def search_sync(self, search: str, strategy: int) -> list[dict]:
+        def search_inner(session):
+            return dump_models(Place.CompressedModel, Place.get_all(SyncSessionAdapter(session), search,
+                                                                     strategy=strategy))
+
+        async with self.sessionmaker() as session:
+            return await session.run_sync(search_inner)
+
+    async def run_stages(self, stages: Generator[tuple, list[list], list[Place]]) -> list[Place]:
+        try:
+            statements = next(stages)
+            while True:
+                statements = stages.send(list(await gather(*(self.scalars(statement) for statement in statements))))
+        except StopIteration as e:
+            return e.value
+
+    async def get_all(self, search: str, total: int = None) -> list[Place]:
+        """Strategy 0 of :meth:`Place.get_all` with independent lookups running concurrently"""
+        if Place.is_search_invalid(search):
+            return []
+        search = canonicalize(search)
+        if len(search) == 0:
+            return []
+
+        if total is None:
+            total = Place.default_total(search)
+
+        for length in Place.TRY_LENGTHS:
+            if len(search) > length:
+                return Place.filter_ranked(await self.get_all(search[:length], total + 1), search)
+
+        return await self.run_stages(Place.search_stages(search, total, PLACE_LOAD_OPTIONS))
+
+    async def search(self, search: str) -> list[dict]:
+        if Place.STRATEGY != 0:
+            return await self.search_sync(search, Place.STRATEGY)
+        return dump_models(Place.CompressedModel, await self.get_all(search))
+
+    async def get_county_index(self) -> list[dict]:
+        async with self.sessionmaker() as session:
+            counties = list(await session.scalars(select(County)))
+        regions = await gather(*(self.get_places(Place.select_regions_by_county(county.id)) for county in counties))
+        return [dict(County.BaseModel.convert(county).dict(), regions=dump_models(Place.RegionModel, county_regions))
+                for county, county_regions in zip(counties, regions)]
+
+    async def get_most_populous(self, region_id: int) -> list[dict] | None:
+        region, settlements = await gather(self.get_first(select(Region.id).filter_by(id=region_id)),
+                                           self.get_places(Place.select_most_populous(region_id)))
+        if region is None:
+            return None
+        return dump_models(Place.SettlementModel, settlements)
+
+
+class AsyncLocationsApp:
+    def __init__(self, sessionmaker: async_sessionmaker, search_cache=None, important_cache=None,
+                 config_path: str = "locations.json", disable_revalidation: bool = False,
+                 prefix: str = "", config_refresh: float = 5):
+        self.searcher = AsyncLocationsSearcher(sessionmaker)
+        self.search_cache = AsyncMemoryCache() if search_cache is None else search_cache
+        self.important_cache = AsyncMemoryCache() if important_cache is None else important_cache
+        self.config = LocationsConfig()
+        self.config_path = config_path
+        self.config_refresh = config_refresh
+        self.disable_revalidation = disable_revalidation
+        self.prefix = prefix.rstrip("/")
+
+    async def refresh_config(self):
+        if self.config.reload(self.config_path, self.config_refresh):
+            await gather(self.search_cache.clear(), self.important_cache.clear())
+        if self.config.last_modified is None:  # missing or malformed config, retried on the next refresh
+            self.config.last_modified = datetime.now(timezone.utc)
+
+    async def cached(self, cache, key_prefix: str, key: str, generator) -> tuple[int, bytes]:
+        counter = cache_counters.setdefault(key_prefix, CacheCounter())
+        key = f"{prepare_datetime(self.config.last_modified)}-{key_prefix}{key}"
+        body = await cache.get(key)
+        if body is not None:
+            counter.hits += 1
+            return 200, body
+
+        counter.misses += 1
+        data = await generator()
+        if data is None:
+            return 404, dumps(Region.not_found_text).encode("utf-8")
+        body = dumps(data).encode("utf-8")
+        await cache.set(key, body)
+        return 200, body
+
+    async def handle(self, path: str, query: dict[str, list[str]]) -> tuple[int, bytes]:
+        if path == "/search/":
+            search = query.get("search", [""])[0]
+            if len(search) == 0:
+                return 400, dumps("Empty search").encode("utf-8")
+            if Place.is_search_invalid(search):
+                return 200, b"[]"
+            search = canonicalize(search)
+            if len(search) == 0:
+                return 400, dumps("Empty search").encode("utf-8")
+            return await self.cached(self.search_cache, "search-", search, lambda: self.searcher.search(search))
+
+        if path == "/counties/":
+            return await self.cached(self.important_cache, "counties", "", self.searcher.get_county_index)
+
+        match = REGION_PATH.match(path)
+        if match is not None:
+            region_id = int(match.group(1))
+            return await self.cached(self.important_cache, "region-", str(region_id),
+                                     lambda: self.searcher.get_most_populous(region_id))
+
+        return 404, b""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await self.refresh_config()
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        await self.refresh_config()
+        path = scope["path"]
+        if not path.startswith(self.prefix):
+            status, body = 404, b""
+        elif scope["method"] not in ("GET", "HEAD"):
+            status, body = 405, b""
+        else:
+            headers = dict(scope["headers"])
+            if_modified_since = headers.get(b"if-modified-since")
+            if not self.disable_revalidation and if_modified_since is not None \
+                    and self.config.compare_expiry(parse_date(if_modified_since.decode("latin-1"))):
+                status, body = 304, b""
+            else:
+                query = parse_qs(scope["query_string"].decode("utf-8"))
+                status, body = await self.handle(path[len(self.prefix):], query)
+
+        headers = [(b"content-type", b"application/json")]
+        if status != 304:
+            headers.append((b"content-length", str(len(body)).encode()))
+        if status in (200, 304):
+            headers.append((b"last-modified", http_date(self.config.last_modified).encode("latin-1")))
+            headers.append((b"x-accel-expires", b"@1"))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": b"" if scope["method"] == "HEAD" else body})
+
+
+def create_async_app(database_url: str, search_cache=None, important_cache=None, **kwargs) -> AsyncLocationsApp:
+    engine = create_async_engine(database_url)
+    return AsyncLocationsApp(async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False),
+                             search_cache, important_cache, **kwargs)
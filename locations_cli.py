@@ -6,13 +6,16 @@ from json import load
 from time import time
 from typing import IO
 
-from click import echo, argument, File, option
+from click import echo, argument, File, option, Choice
 from flask import Blueprint, current_app
 
 from common import sessionmaker
 from moderation import permission_index
 from .locations_db import Region, Municipality, SettlementType, Settlement, Place, County
+from .locations_exp import export_locations
 from .locations_ini import locations_config
+from .locations_lod import SCENARIOS, sample_workload, run_scenario
+from .locations_xpl import collect_statements, format_report
 
 manage_locations = permission_index.add_permission("manage locations")
 locations_cli_blueprint = Blueprint("locations", __name__)
@@ -103,6 +106,16 @@ def delete_locations(session, clear_cache: bool = True):
     locations_config.update_now(current_app, clear_cache)
 
 
+def export_locations_safely() -> str | None:
+    """Exports in a separate transaction, so has to be called after the data update is committed"""
+    try:
+        with sessionmaker.begin() as session:
+            return export_locations(session, current_app)
+    except Exception:  # the data update is already committed, failing here should not undo it
+        current_app.logger.exception("Failed to export locations")
+        return None
+
+
 def time_one(session, search: str, strategy: int) -> tuple[float, set[int]]:
     count = 4
     speed = 0
@@ -137,23 +150,73 @@ def mark_updated(save_cache: bool):
     mark_locations_updated(not save_cache)
 
 
-@permission_cli_command()
+def echo_export():
+    if current_app.config.get("NQ_LOCATIONS_EXPORT_PATH") is None:
+        return echo("NQ_LOCATIONS_EXPORT_PATH is not configured")
+    version = export_locations_safely()
+    if version is None:
+        echo("FATAL: Export failed, see the log for details")
+    else:
+        echo(f"Exported version {version}")
+
+
+@permission_cli_command(False)
 @argument("csv", type=File("rb"))
 @option("-s", "--save-cache", is_flag=True)
-def upload(session, csv: IO[bytes], save_cache: bool):
+def upload(csv: IO[bytes], save_cache: bool):
     try:
-        upload_locations(session, csv, not save_cache)
+        with sessionmaker.begin() as session:
+            upload_locations(session, csv, not save_cache)
     except ValueError as e:
-        print(e.args[0])
+        return print(e.args[0])
+    echo_export()
 
 
-@permission_cli_command()
+@permission_cli_command(False)
 @option("-s", "--save-cache", is_flag=True)
-def delete(session, save_cache: bool):
-    delete_locations(session, not save_cache)
+def delete(save_cache: bool):
+    with sessionmaker.begin() as session:
+        delete_locations(session, not save_cache)
+    echo_export()
+
+
+@permission_cli_command(False)
+def export():
+    echo_export()
 
 
 @permission_cli_command()
 @argument("data", type=File(encoding="utf-8"))
 def test(session, data):
     test_search(session, load(data))
+
+
+@permission_cli_command()
+@argument("search")
+@option("--county-id", type=int)
+@option("--region-id", type=int)
+@option("-T", "--no-timing", is_flag=True, help="Omit timings to make reports diffable")
+def explain(session, search: str, county_id: int | None, region_id: int | None, no_timing: bool):
+    statements = collect_statements(session, search, STRATEGIES, county_id, region_id)
+    for line in format_report(statements, not no_timing):
+        echo(line)
+
+
+@permission_cli_command()
+@option("-n", "--users", default=200, help="Number of typeahead sequences to replay")
+@option("-c", "--concurrency", default=8, help="Number of concurrent client threads")
+@option("-p", "--processes", default=1, help="Number of forked server workers (threaded), 0 to serve in-process")
+@option("-t", "--timeout", default=10.0, help="Request timeout in seconds, timed out requests count as errors")
+@option("--prefix", default="/locations", help="Path under which the locations controller is mounted")
+@option("--tree-share", default=0.1, help="Share of sequences which also request tree endpoints")
+@option("--scenario", "scenarios", multiple=True, type=Choice(SCENARIOS))
+@option("--seed", type=int)
+def bench(session, users: int, concurrency: int, processes: int, timeout: float, prefix: str,
+          tree_share: float, scenarios: tuple[str, ...], seed: int | None):
+    workload = sample_workload(session, users, tree_share, seed=seed)
+    if len(workload) == 0:
+        return echo("No settlements to sample the workload from")
+    echo(f"Replaying {sum(len(sequence) for sequence in workload)} requests from {len(workload)} sequences")
+    app = current_app._get_current_object()
+    for scenario in scenarios or SCENARIOS:
+        echo(run_scenario(app, scenario, workload, prefix, concurrency, processes, timeout).format())
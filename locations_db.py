@@ -1,8 +1,10 @@
 from __future__ import annotations
 
-from typing import Type, TypeVar, Iterable
+from sqlite3 import Connection as SQLiteConnection
+from typing import Type, TypeVar, Iterable, Generator
 
-from sqlalchemy import Column, ForeignKey, select, delete, or_, and_, Index
+from sqlalchemy import Column, ForeignKey, select, delete, or_, and_, Index, func, bindparam, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.functions import count
 from sqlalchemy.sql.sqltypes import Integer, String, Text, Float
@@ -11,6 +13,41 @@ from common import PydanticModel, Base, Identifiable
 
 t = TypeVar("t", bound="LocalBase")
 
+CANONICAL_REPLACEMENTS: dict[str, str] = {"ё": "е", "«": "\"", "»": "\"", "—": "-"}
+
+
+def canonicalize(text: str) -> str:
+    text = " ".join(text.lower().split())
+    for symbol, replacement in CANONICAL_REPLACEMENTS.items():
+        text = text.replace(symbol, replacement)
+    return text
+
+
+def unicode_lower(text: str | None) -> str | None:
+    return text.lower() if isinstance(text, str) else text
+
+
+@event.listens_for(Engine, "connect")
+def register_unicode_lower(dbapi_connection, _connection_record):
+    # SQLite's lower() only folds ASCII, it has to match str.lower used in canonicalize
+    if isinstance(dbapi_connection, SQLiteConnection) \
+            or type(dbapi_connection).__module__.endswith("sqlite.aiosqlite"):
+        dbapi_connection.create_function("lower", 1, unicode_lower, deterministic=True)
+
+
+def canonical_column(column: Column):
+    # replacements are rendered inline for queries to match the expression indexes from canonical_name_index
+    result = func.lower(column)
+    for symbol, replacement in CANONICAL_REPLACEMENTS.items():
+        result = func.replace(result, bindparam(None, symbol, literal_execute=True),
+                              bindparam(None, replacement, literal_execute=True))
+    return result
+
+
+def canonical_name_index(name: str, column: Column, *expressions) -> Index:
+    return Index(name, canonical_column(column).label("canonical_name"), *expressions,
+                 postgresql_ops={"canonical_name": "text_pattern_ops"})
+
 
 class LocalBase(Base, Identifiable):
     __abstract__ = True
@@ -27,6 +64,10 @@ class LocalBase(Base, Identifiable):
     def find_by_id(cls: Type[t], session, entry_id: int) -> t | None:
         return session.get_first(select(cls).filter_by(id=entry_id))
 
+    @classmethod
+    def name_like(cls, pattern: str):
+        return canonical_column(cls.name).like(pattern)
+
     @classmethod
     def find_or_create(cls: Type[t], session, name: str, **kwargs) -> t:
         entry = session.get_first(select(cls).filter_by(name=name))
@@ -119,8 +160,8 @@ class Settlement(LocalBase):
         return result, Place.create(session, name, result.mun.reg_id, mun_id, type_id, result.id, population)
 
 
-def ilike_with_none(column: Column, search: str):
-    return or_(column.ilike(search), None)
+def like_with_none(column: Column, search: str):
+    return or_(canonical_column(column).like(search), None)
 
 
 class Place(LocalBase):
@@ -141,6 +182,7 @@ class Place(LocalBase):
 
     ALLOWED_SYMBOLS: set[str] = set(" \"()+-./0123456789<>ENU_clnux«»ЁАБВГДЕЖЗИЙКЛМНОПРСТУФХЦЧШЩЫЭЮЯ"
                                     "абвгдежзийклмнопрстуфхцчшщъыьэюяё—№")
+    CANONICAL_SYMBOLS: set[str] = set(canonicalize("".join(sorted(ALLOWED_SYMBOLS)))) | {" "}
     JOINS = [(Region, reg_id), (Municipality, mun_id), (Settlement, set_id)]
     STRATEGY: int = 0
     TOTAL: int = None
@@ -180,149 +222,181 @@ class Place(LocalBase):
         return super().create(session, name=name, reg_id=reg_id, mun_id=mun_id,
                               type_id=type_id, set_id=set_id, population=population)
 
+    @classmethod
+    def select_regions_by_county(cls, county_id: int):
+        return select(cls).filter(cls.mun_id.is_(None)).join(Region).filter_by(cty_id=county_id).order_by(cls.name)
+
     @classmethod
     def get_regions_by_county(cls, session, county_id: int) -> list[Place]:
-        return session.get_all(
-            select(cls)
-            .filter(cls.mun_id.is_(None))
-            .join(Region)
-            .filter_by(cty_id=county_id)
-            .order_by(cls.name)
-        )
+        return session.get_all(cls.select_regions_by_county(county_id))
 
     @classmethod
-    def get_most_populous(cls, session, reg_id: int, limit: int = 20) -> list[Place]:
+    def select_most_populous(cls, reg_id: int, limit: int = 20):
         stmt = select(cls).filter_by(reg_id=reg_id).filter(cls.set_id.is_not(None))
-        stmt = stmt.order_by(cls.population.desc()).limit(limit)
-        return session.get_all(stmt)
+        return stmt.order_by(cls.population.desc()).limit(limit)
+
+    @classmethod
+    def get_most_populous(cls, session, reg_id: int, limit: int = 20) -> list[Place]:
+        return session.get_all(cls.select_most_populous(reg_id, limit))
 
     @classmethod
     def is_search_invalid(cls, search: str) -> bool:
-        return len(search) > 60 or any(sym not in cls.ALLOWED_SYMBOLS for sym in search)
+        search = canonicalize(search)
+        return len(search) > 60 or any(sym not in cls.CANONICAL_SYMBOLS for sym in search)
+
+    @classmethod
+    def default_total(cls, search: str) -> int:
+        return cls.TOTAL or (100 // (len(search) * 2) if len(search) < 6 else 5)
+
+    @classmethod
+    def rank(cls, place: Place, search: str) -> int:
+        if place.mun_id is None:
+            return 20
+        if place.set_id is None:
+            return 50 if search in canonicalize(place.reg.name) else 10
+        result = 0
+        if search in canonicalize(place.reg.name):
+            result += 50
+        if search in canonicalize(place.mun.name):
+            result += 20
+        return result
+
+    @classmethod
+    def full_rank(cls, place: Place, search: str) -> tuple[int, int]:
+        return cls.rank(place, search), place.population
+
+    @classmethod
+    def filter_ranked(cls, places: list[Place], search: str) -> list[Place]:
+        places = [place for place in places if search in canonicalize(place.name)]
+        places.sort(key=lambda place: cls.full_rank(place, search), reverse=True)
+        return places
+
+    @classmethod
+    def search_stages(cls, search: str, total: int, place_options: tuple = ()) \
+            -> Generator[tuple, list[list], list[Place]]:
+        """Yields tuples of independent statements, receives their results, returns found places"""
+        search_pattern = search + "%"
+        results: list[Place] = []
+        result_ids = set()
+        stmt = select(Settlement.id).order_by(Settlement.population.desc())
+        p_stmt = select(cls).options(*place_options).order_by(cls.population.desc())
+
+        def place_all(places: list[Place]):
+            places = [p for p in places if p.id not in result_ids]
+            results.extend(places)
+            result_ids.update(set(p.id for p in places))
+            return len(results) >= total
+
+        def select_set(subquery):
+            subquery = subquery.filter(Settlement.name_like(search_pattern)).limit(total - len(result_ids))
+            return p_stmt.filter(cls.id.not_in(result_ids)).filter(cls.set_id.in_(subquery))
+
+        def select_other(query):
+            return query.filter(cls.id.not_in(result_ids)).limit(total - len(result_ids))
+
+        regions, municipalities = yield (select(Region.id).filter(Region.name_like(search_pattern)),
+                                         select(Municipality.id).filter(Municipality.name_like(search_pattern)))
+        mun_stmt = select(Municipality.id).filter(Municipality.id.in_(municipalities))
+
+        if len(regions):
+            mun_regs, = yield mun_stmt.filter(Municipality.reg_id.in_(regions)),
+            if len(mun_regs):
+                places, = yield select_set(stmt.filter(Settlement.mun_id.in_(mun_regs))),
+                if place_all(places):
+                    return results
+
+            places, = yield select_other(p_stmt.filter(cls.reg_id.in_(regions), cls.set_id.is_not(None),
+                                                       cls.name_like(search_pattern))),
+            if place_all(places):
+                return results
+
+            places, = yield select_other(p_stmt.filter(cls.mun_id.is_(None), cls.reg_id.in_(regions))),
+            if place_all(places):
+                return results
+
+        if len(municipalities):
+            places, = yield select_other(p_stmt.filter(cls.set_id.is_(None), cls.mun_id.in_(municipalities))),
+            if place_all(places):
+                return results
+
+        places, = yield select_set(stmt),
+        place_all(places)
+        return results
+
+    @classmethod
+    def run_stages(cls, session, stages: Generator[tuple, list[list], list[Place]]) -> list[Place]:
+        try:
+            statements = next(stages)
+            while True:
+                statements = stages.send([session.get_all(statement) for statement in statements])
+        except StopIteration as e:
+            return e.value
 
     @classmethod
     def get_all(cls, session, search: str, total: int = None, strategy: int = None) -> list[Place]:
         if cls.is_search_invalid(search):
             return []
+        search = canonicalize(search)
+        if len(search) == 0:
+            return []
 
         if strategy is None:
             strategy = cls.STRATEGY
         if total is None:
-            total = cls.TOTAL or (100 // (len(search) * 2) if len(search) < 6 else 5)
+            total = cls.default_total(search)
         search_pattern = search + "%"
 
-        def rank(place: Place):
-            if place.mun_id is None:
-                return 20
-            if place.set_id is None:
-                return 50 if search in place.reg.name else 10
-            result = 0
-            if search in place.reg.name:
-                result += 50
-            if search in place.mun.name:
-                result += 20
-            return result
-
-        def full_rank(place: Place):
-            return rank(place), place.population
-
         if strategy % 2 == 0:
             for length in cls.TRY_LENGTHS:
                 if len(search) > length:
                     results = cls.get_all(session, search[:length], total + 1)
                     if results != total + 1:
-                        results = [r for r in results if search.lower() in r.name.lower()]
-                        results.sort(key=full_rank, reverse=True)
-                        return results
+                        return cls.filter_ranked(results, search)
 
         if strategy // 4 == 0:
             if strategy == 1 and len(search) > 4:
-                results = session.get_all(select(cls).filter(cls.name.ilike(search[:4] + "%"))
+                results = session.get_all(select(cls).filter(cls.name_like(search[:4] + "%"))
                                           .order_by(cls.population).limit(total + 1))
                 if len(results) != total + 1:
-                    results = [r for r in results if search.lower() in r.name.lower()]
-                    results.sort(key=full_rank, reverse=True)
-                    return results
-
-            results: list[Place] = []
-            result_ids = set()
-            stmt = select(Settlement.id).order_by(Settlement.population.desc())
-            p_stmt = select(cls).order_by(cls.population.desc())
-
-            def place_all(places: list[Place]):
-                places = [p for p in places if p.id not in result_ids]
-                results.extend(places)
-                result_ids.update(set(p.id for p in places))
-                return len(results) >= total
-
-            def place_all_set(subquery):
-                subquery = subquery.filter(Settlement.name.ilike(search_pattern)).limit(total - len(result_ids))
-                stmt = p_stmt.filter(cls.id.not_in(result_ids)).filter(cls.set_id.in_(subquery))
-                return place_all(session.get_all(stmt))
-
-            def place_all_other(query):
-                query = query.filter(cls.id.not_in(result_ids)).limit(total - len(result_ids))
-                return place_all(session.get_all(query))
-
-            regions = session.get_all(select(Region.id).filter(Region.name.ilike(search_pattern)))
-            municipalities = session.get_all(select(Municipality.id).filter(Municipality.name.ilike(search_pattern)))
-            mun_stmt = select(Municipality.id).filter(Municipality.id.in_(municipalities))
-
-            if len(regions):
-                mun_regs = session.get_all(mun_stmt.filter(Municipality.reg_id.in_(regions)))
-                if len(mun_regs) and place_all_set(stmt.filter(Settlement.mun_id.in_(mun_regs))):
-                    return results
-
-                if place_all_other(p_stmt.filter(cls.reg_id.in_(regions), cls.set_id.is_not(None),
-                                                 cls.name.ilike(search_pattern))):
-                    return results
+                    return cls.filter_ranked(results, search)
 
-            if len(regions) and place_all_other(p_stmt.filter(cls.mun_id.is_(None), cls.reg_id.in_(regions))):
-                return results
-
-            if len(municipalities) and place_all_other(
-                    p_stmt.filter(cls.set_id.is_(None), cls.mun_id.in_(municipalities))):
-                return results
-
-            place_all_set(stmt)
-
-            return results
+            return cls.run_stages(session, cls.search_stages(search, total))
 
         elif strategy // 4 == 1:
             stmt = select(cls).order_by(cls.population.desc())
             result_ids = set()
             results = session.get_all(
                 stmt.limit(total)
-                .filter(cls.set_id.is_not(None), cls.name.ilike(search_pattern))
-                .join(Region, and_(cls.reg_id == Region.id, Region.name.ilike(search_pattern)))
-                .join(Municipality, and_(cls.mun_id == Municipality.id, Municipality.name.ilike(search_pattern)))
+                .filter(cls.set_id.is_not(None), cls.name_like(search_pattern))
+                .join(Region, and_(cls.reg_id == Region.id, Region.name_like(search_pattern)))
+                .join(Municipality, and_(cls.mun_id == Municipality.id, Municipality.name_like(search_pattern)))
             )
             result_ids.update(set(r.id for r in results))
 
             results += session.get_all(
                 stmt.limit(total - len(results))
-                .filter(cls.id.notin_(result_ids), cls.set_id.is_not(None), cls.name.ilike(search_pattern))
-                .join(Region, and_(cls.reg_id == Region.id, Region.name.ilike(search_pattern)))
+                .filter(cls.id.notin_(result_ids), cls.set_id.is_not(None), cls.name_like(search_pattern))
+                .join(Region, and_(cls.reg_id == Region.id, Region.name_like(search_pattern)))
             )
             result_ids.update(set(r.id for r in results))
 
             results += session.get_all(
                 stmt.limit(total - len(results))
                 .filter(cls.id.notin_(result_ids), cls.mun_id.is_(None))
-                .join(Region, and_(cls.reg_id == Region.id, Region.name.ilike(search_pattern)))
+                .join(Region, and_(cls.reg_id == Region.id, Region.name_like(search_pattern)))
             )
             result_ids.update(set(r.id for r in results))
 
             results += session.get_all(
                 stmt.limit(total - len(results))
                 .filter(cls.id.notin_(result_ids), cls.set_id.is_(None), cls.mun_id.is_not(None))
-                .join(Municipality, and_(cls.mun_id == Municipality.id, Municipality.name.ilike(search_pattern)))
+                .join(Municipality, and_(cls.mun_id == Municipality.id, Municipality.name_like(search_pattern)))
             )
             result_ids.update(set(r.id for r in results))
 
             results += session.get_all(
                 stmt.limit(total - len(results))
-                .filter(cls.id.notin_(result_ids), cls.set_id.is_not(None), cls.name.ilike(search_pattern))
+                .filter(cls.id.notin_(result_ids), cls.set_id.is_not(None), cls.name_like(search_pattern))
             )
             result_ids.update(set(r.id for r in results))
 
@@ -333,34 +407,34 @@ class Place(LocalBase):
             stmt = stmt.outerjoin(part, column == part.id)
 
         stmt = stmt.filter(or_(
-            and_(Region.name.ilike(search_pattern), cls.set_id.is_(None), cls.mun_id.is_(None)),
-            and_(Municipality.name.ilike(search_pattern), cls.set_id.is_(None), cls.mun_id.is_not(None)),
-            and_(Settlement.name.ilike(search_pattern), cls.set_id.is_not(None), cls.mun_id.is_not(None)),
+            and_(Region.name_like(search_pattern), cls.set_id.is_(None), cls.mun_id.is_(None)),
+            and_(Municipality.name_like(search_pattern), cls.set_id.is_(None), cls.mun_id.is_not(None)),
+            and_(Settlement.name_like(search_pattern), cls.set_id.is_not(None), cls.mun_id.is_not(None)),
         ))
 
         stmt = stmt.order_by(
-            and_(ilike_with_none(Region.name, search_pattern), ilike_with_none(Municipality.name, search_pattern),
-                 ilike_with_none(Settlement.name, search_pattern)),
-            and_(ilike_with_none(Region.name, search_pattern), ilike_with_none(Settlement.name, search_pattern)),
-            and_(ilike_with_none(Region.name, search_pattern), ilike_with_none(Settlement.name, search_pattern)),
-            and_(ilike_with_none(Region.name, search_pattern), ilike_with_none(Municipality.name, search_pattern)),
-            ilike_with_none(Region.name, search_pattern),
-            ilike_with_none(Municipality.name, search_pattern),
-            ilike_with_none(Settlement.name, search_pattern),
+            and_(like_with_none(Region.name, search_pattern), like_with_none(Municipality.name, search_pattern),
+                 like_with_none(Settlement.name, search_pattern)),
+            and_(like_with_none(Region.name, search_pattern), like_with_none(Settlement.name, search_pattern)),
+            and_(like_with_none(Region.name, search_pattern), like_with_none(Settlement.name, search_pattern)),
+            and_(like_with_none(Region.name, search_pattern), like_with_none(Municipality.name, search_pattern)),
+            like_with_none(Region.name, search_pattern),
+            like_with_none(Municipality.name, search_pattern),
+            like_with_none(Settlement.name, search_pattern),
             cls.population.desc()
         )
 
         return session.get_all(stmt.limit(total))
 
 
-Index("idx_nq_region_name", Region.name)
-Index("idx_nq_municipality_name", Municipality.name)
-Index("idx_nq_settlement_name", Settlement.name)
+canonical_name_index("idx_nq_region_canonical_name", Region.name)
+canonical_name_index("idx_nq_municipality_canonical_name", Municipality.name)
+canonical_name_index("idx_nq_settlement_canonical_name", Settlement.name)
 Index("idx_nq_settlement_population", Settlement.population.desc())
 
-Index("idx_nq_place_name", Place.name)
+canonical_name_index("idx_nq_place_canonical_name", Place.name)
 Index("idx_nq_place_reg_id", Place.reg_id)
 Index("idx_nq_place_mun_id", Place.mun_id)
 Index("idx_nq_place_set_id", Place.set_id)
 Index("idx_nq_place_population", Place.population.desc())
-Index("idx_nq_place_name_population", Place.name, Place.population.desc())
+canonical_name_index("idx_nq_place_canonical_name_population", Place.name, Place.population.desc())
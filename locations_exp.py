@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+from gzip import compress
+from os import makedirs, listdir, rename, utime
+from os.path import join, dirname, isfile
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from flask import Flask
+from flask.json import dumps
+from sqlalchemy import select
+
+from .locations_db import Place, County, Region
+from .locations_ini import locations_config, prepare_datetime
+
+COUNTIES_FILENAME = "counties.json"
+REGION_FILENAME = "regions/{}.json"
+KEEP_VERSIONS = 2
+
+
+@County.BaseModel.include_context("session")
+class CountyIndexModel(County.BaseModel):
+    regions: list[Place.RegionModel]
+
+    @classmethod
+    def callback_convert(cls, callback, orm_object: County, session=None, **_):
+        callback(regions=[Place.RegionModel.convert(reg)
+                          for reg in Place.get_regions_by_county(session, orm_object.id)])
+
+
+def dump_models(model, orm_objects: list, **context) -> list[dict]:
+    return [model.convert(orm_object, **context).dict() for orm_object in orm_objects]
+
+
+def export_version() -> str:
+    return str(prepare_datetime(locations_config.last_modified))
+
+
+def find_export(app: Flask, filename: str) -> str | None:
+    export_path = app.config.get("NQ_LOCATIONS_EXPORT_PATH")
+    if export_path is None:
+        return None
+    version = export_version()
+    if not isfile(join(export_path, version, filename)):
+        return None
+    return "/".join((app.config.get("NQ_LOCATIONS_EXPORT_URI", "/locations-export").rstrip("/"), version, filename))
+
+
+def write_export(directory: str, filename: str, data, timestamp: int):
+    path = join(directory, filename)
+    makedirs(dirname(path), exist_ok=True)
+    content = dumps(data).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(content)
+    with open(path + ".gz", "wb") as f:
+        f.write(compress(content, mtime=timestamp))
+    utime(path, (timestamp, timestamp))
+    utime(path + ".gz", (timestamp, timestamp))
+
+
+def cleanup_exports(export_path: str):
+    versions = sorted((entry for entry in listdir(export_path) if entry.isdigit()), key=int)
+    for version in versions[:-KEEP_VERSIONS]:
+        rmtree(join(export_path, version), ignore_errors=True)
+
+
+def export_locations(session, app: Flask) -> str | None:
+    export_path = app.config.get("NQ_LOCATIONS_EXPORT_PATH")
+    if export_path is None:
+        return None
+    makedirs(export_path, exist_ok=True)
+
+    version = export_version()
+    timestamp = prepare_datetime(locations_config.last_modified)
+    temp_path = mkdtemp(prefix=f".{version}-", dir=export_path)
+    try:
+        counties = County.get_all(session)
+        write_export(temp_path, COUNTIES_FILENAME, dump_models(CountyIndexModel, counties, session=session), timestamp)
+        for region in session.get_all(select(Region)):
+            settlements = Place.get_most_populous(session, region.id)
+            write_export(temp_path, REGION_FILENAME.format(region.id),
+                         dump_models(Place.SettlementModel, settlements), timestamp)
+
+        target_path = join(export_path, version)
+        rmtree(target_path, ignore_errors=True)
+        rename(temp_path, target_path)
+    except Exception:
+        rmtree(temp_path, ignore_errors=True)
+        raise
+
+    cleanup_exports(export_path)
+    return version
@@ -3,6 +3,8 @@ from __future__ import annotations
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from json import load, dump
+from os import stat
+from time import monotonic
 
 from flask import Flask
 
@@ -11,14 +13,21 @@ def prepare_datetime(dt: datetime) -> int:
     return int(dt.timestamp())
 
 
+def get_config_path(app: Flask) -> str:
+    return app.config.get("NQ_LOCATIONS_CONFIG_PATH", "locations.json")
+
+
 @dataclass()
 class LocationsConfig:
     last_modified: datetime = None
     caches: list = None
+    mtime: float = None
+    checked: float = None
 
     def save(self, app: Flask):
-        with open(app.config.get("NQ_LOCATIONS_CONFIG_PATH", "locations.json"), "w", encoding="utf-8") as f:
+        with open(get_config_path(app), "w", encoding="utf-8") as f:
             dump({"updated": locations_config.last_modified.isoformat()}, f, ensure_ascii=False)
+        self.mtime = stat(get_config_path(app)).st_mtime
 
     def update_now(self, app: Flask, clear_cache: bool = True):
         self.last_modified = datetime.now(timezone.utc)
@@ -27,13 +36,37 @@ class LocationsConfig:
             for cache in self.caches or []:
                 cache.clear()
 
+    def read(self, path: str):
+        mtime = stat(path).st_mtime
+        with open(path, "r", encoding="utf-8") as f:
+            self.last_modified = datetime.fromisoformat(load(f)["updated"])
+        self.mtime = mtime
+
     def load(self, app: Flask, clear_cache: bool = True):
         try:
-            with open(app.config.get("NQ_LOCATIONS_CONFIG_PATH", "locations.json"), "r", encoding="utf-8") as f:
-                self.last_modified = datetime.fromisoformat(load(f)["updated"])
+            self.read(get_config_path(app))
         except (FileNotFoundError, ValueError):
             self.update_now(app, clear_cache)
 
+    def reload(self, path: str, interval: float) -> bool:
+        """Re-reads the file if it was changed (by another process), checks at most once per interval"""
+        if self.checked is not None and monotonic() - self.checked < interval:
+            return False
+        self.checked = monotonic()
+        last_modified = self.last_modified
+        try:
+            if stat(path).st_mtime == self.mtime:
+                return False
+            self.read(path)
+        except (FileNotFoundError, ValueError, KeyError):  # retried on the next check
+            return False
+        return self.last_modified != last_modified
+
+    def refresh(self, app: Flask):
+        if self.reload(get_config_path(app), app.config.get("NQ_LOCATIONS_CONFIG_REFRESH", 5)):
+            for cache in self.caches or []:
+                cache.clear()
+
     def compare_expiry(self, other_date: datetime | None):
         return other_date is not None and prepare_datetime(self.last_modified) <= prepare_datetime(other_date)
 
@@ -41,6 +74,28 @@ class LocationsConfig:
 locations_config = LocationsConfig()
 
 
+@dataclass()
+class CacheCounter:
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def dict(self) -> dict[str, int | float]:
+        return {"hits": self.hits, "misses": self.misses, "hit-rate": self.hit_rate}
+
+
+cache_counters: dict[str, CacheCounter] = {}
+
+
+def reset_cache_counters():
+    for counter in cache_counters.values():
+        counter.hits, counter.misses = 0, 0
+
+
 def init_locations(app, *caches):
     locations_config.load(app)
     locations_config.caches = caches
@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from multiprocessing import get_context
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+from os import getpid
+from random import Random
+from threading import Thread
+from time import perf_counter
+from typing import Iterator
+from urllib.error import HTTPError, URLError
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+
+from flask import Flask
+from sqlalchemy import select, event
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import Pool
+from werkzeug.http import http_date
+from werkzeug.serving import make_server
+
+from .locations_db import Place
+from .locations_ini import locations_config, cache_counters, reset_cache_counters, CacheCounter
+
+SCENARIOS = ("cold", "warm", "revalidate", "no-revalidation")
+PERCENTILES = (50, 90, 99)
+ERROR_STATUS = "error"
+
+
+@dataclass()
+class LoadReport:
+    scenario: str
+    elapsed: float = 0
+    latencies: list[float] = field(default_factory=list)
+    statuses: Counter = field(default_factory=Counter)
+    cache_hit_rates: dict[str, float] = field(default_factory=dict)
+
+    def percentile(self, percent: int) -> float:
+        if len(self.latencies) == 0:
+            return 0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, round(percent / 100 * (len(latencies) - 1)))]
+
+    def format(self) -> str:
+        rps = len(self.latencies) / self.elapsed if self.elapsed else 0
+        percentiles = " | ".join(f"p{percent}: {self.percentile(percent) * 1000:.2f}ms" for percent in PERCENTILES)
+        statuses = ", ".join(f"{status}: {amount}" for status, amount in sorted(self.statuses.items(), key=str))
+        hit_rates = ", ".join(f"{key_prefix}: {hit_rate:.0%}" for key_prefix, hit_rate in self.cache_hit_rates.items())
+        return (f"[{self.scenario}] {len(self.latencies)} requests in {self.elapsed:.2f}s | {rps:.1f} req/s | "
+                f"{percentiles} | max: {max(self.latencies, default=0) * 1000:.2f}ms | statuses: {statuses} | "
+                f"cache hit rates: {hit_rates or '-'}")
+
+
+def sample_workload(session, users: int, tree_share: float = 0.1, min_prefix: int = 2,
+                    seed: int = None) -> list[list[str]]:
+    random = Random(seed)
+    places = session.get_all(select(Place).filter(Place.set_id.is_not(None)))
+    if len(places) == 0:
+        return []
+
+    workload: list[list[str]] = []
+    for place in random.choices(places, weights=[place.population + 1 for place in places], k=users):
+        sequence = [f"/search/?search={quote(place.name[:length])}"
+                    for length in range(min_prefix, len(place.name) + 1)
+                    if not Place.is_search_invalid(place.name[:length])]
+        if random.random() < tree_share:
+            sequence.append("/counties/")
+            sequence.append(f"/regions/{place.reg_id}/settlements/")
+        workload.append(sequence)
+    return workload
+
+
+def run_sequence(base_url: str, sequence: list[str], headers: dict[str, str],
+                 timeout: float) -> list[tuple[float, int | str]]:
+    results = []
+    for path in sequence:
+        timer = perf_counter()
+        try:
+            with urlopen(Request(base_url + path, headers=headers), timeout=timeout) as response:
+                response.read()
+                status = response.status
+        except HTTPError as e:
+            status = e.code
+        except (URLError, OSError):  # includes timeouts & connection resets
+            status = ERROR_STATUS
+        results.append((perf_counter() - timer, status))
+    return results
+
+
+def run_workload(base_url: str, workload: list[list[str]], concurrency: int, headers: dict[str, str],
+                 report: LoadReport, timeout: float = 10) -> LoadReport:
+    timer = perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for results in executor.map(lambda sequence: run_sequence(base_url, sequence, headers, timeout), workload):
+            for latency, status in results:
+                report.latencies.append(latency)
+                report.statuses[status] += 1
+    report.elapsed = perf_counter() - timer
+    return report
+
+
+@contextmanager
+def forked_pool_guard() -> Iterator[None]:
+    """Makes forked processes open their own DB connections instead of reusing the parent's sockets"""
+    parent_pid = getpid()
+
+    def on_connect(_dbapi_connection, connection_record):
+        connection_record.info["pid"] = getpid()
+
+    def on_checkout(_dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info.setdefault("pid", parent_pid) != getpid():
+            connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+            raise DisconnectionError("Connection belongs to another process")
+
+    event.listen(Pool, "connect", on_connect)
+    event.listen(Pool, "checkout", on_checkout)
+    try:
+        yield
+    finally:
+        event.remove(Pool, "connect", on_connect)
+        event.remove(Pool, "checkout", on_checkout)
+
+
+def serve_worker(server, connection: Connection):
+    Thread(target=server.serve_forever, daemon=True).start()
+    while (command := connection.recv()) != "stop":
+        if command == "reset":
+            reset_cache_counters()
+            connection.send(None)
+        elif command == "counters":
+            connection.send({key_prefix: (counter.hits, counter.misses)
+                             for key_prefix, counter in cache_counters.items()})
+    server.shutdown()
+
+
+class BenchServer:
+    """Threaded server, run either in this process or in pre-forked worker processes sharing the socket"""
+
+    def __init__(self, app: Flask, processes: int = 0):
+        self.server = make_server("127.0.0.1", 0, app, threaded=True)
+        self.thread: Thread | None = None
+        self.workers: list[tuple[BaseProcess, Connection]] = []
+        if processes == 0:
+            self.thread = Thread(target=self.server.serve_forever, daemon=True)
+            self.thread.start()
+            return
+
+        context = get_context("fork")
+        for _ in range(processes):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=serve_worker, args=(self.server, worker_connection), daemon=True)
+            process.start()
+            self.workers.append((process, connection))
+
+    @property
+    def port(self) -> int:
+        return self.server.server_port
+
+    def reset_counters(self):
+        reset_cache_counters()
+        for _, connection in self.workers:
+            connection.send("reset")
+            connection.recv()
+
+    def collect_counters(self) -> dict[str, CacheCounter]:
+        if len(self.workers) == 0:
+            return dict(cache_counters)
+        counters: dict[str, CacheCounter] = {}
+        for _, connection in self.workers:
+            connection.send("counters")
+            for key_prefix, (hits, misses) in connection.recv().items():
+                counter = counters.setdefault(key_prefix, CacheCounter())
+                counter.hits += hits
+                counter.misses += misses
+        return counters
+
+    def close(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+        for process, connection in self.workers:
+            connection.send("stop")
+            process.join()
+        self.server.server_close()
+
+
+def run_scenario(app: Flask, scenario: str, workload: list[list[str]], prefix: str = "/locations",
+                 concurrency: int = 8, processes: int = 1, timeout: float = 10) -> LoadReport:
+    """
+    Serves the app from ``processes`` forked workers, or from this process if 0 (sharing the GIL with clients).
+    Static export redirects are disabled: without nginx they would only time empty X-Accel-Redirect stubs
+    """
+    headers = {}
+    if scenario in ("revalidate", "no-revalidation"):
+        headers["If-Modified-Since"] = http_date(locations_config.last_modified)
+    if scenario == "cold":
+        for cache in locations_config.caches or []:
+            cache.clear()
+
+    disable_revalidation = app.config.get("NQ_DISABLE_REVALIDATION", False)
+    app.config["NQ_DISABLE_REVALIDATION"] = scenario == "no-revalidation"
+    export_path = app.config.pop("NQ_LOCATIONS_EXPORT_PATH", None)
+    with forked_pool_guard():
+        server = BenchServer(app, processes)
+        try:
+            base_url = f"http://127.0.0.1:{server.port}{prefix.rstrip('/')}"
+            if scenario == "warm":
+                run_workload(base_url, workload, concurrency, headers, LoadReport(scenario), timeout)
+            server.reset_counters()
+            report = run_workload(base_url, workload, concurrency, headers, LoadReport(scenario), timeout)
+            report.cache_hit_rates = {key_prefix: counter.hit_rate for key_prefix, counter
+                                      in server.collect_counters().items() if counter.hits + counter.misses}
+            return report
+        finally:
+            server.close()
+            app.config["NQ_DISABLE_REVALIDATION"] = disable_revalidation
+            if export_path is not None:
+                app.config["NQ_LOCATIONS_EXPORT_PATH"] = export_path
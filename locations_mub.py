@@ -8,8 +8,10 @@ from werkzeug.datastructures import FileStorage
 
 from common import sessionmaker
 from moderation import MUBController
-from .locations_cli import manage_locations, upload_locations, delete_locations, mark_locations_updated
+from .locations_cli import manage_locations, upload_locations, delete_locations, mark_locations_updated, \
+    export_locations_safely
 from .locations_db import Place
+from .locations_ini import cache_counters
 
 
 def setup(controller: MUBController = None) -> MUBController:
@@ -47,17 +49,21 @@ def setup(controller: MUBController = None) -> MUBController:
 
         @controller.doc_abort(400, "Invalid header")
         @controller.doc_abort("400 ", "Invalid line")
-        @controller.require_permission(manage_locations, use_moderator=False)
+        @controller.require_permission(manage_locations, use_session=False, use_moderator=False)
         @controller.argument_parser(parser)
-        def post(self, session, csv: FileStorage, clear_cache: bool):
+        def post(self, csv: FileStorage, clear_cache: bool):
             try:
-                upload_locations(session, csv.stream, clear_cache)
+                with sessionmaker.begin() as session:
+                    upload_locations(session, csv.stream, clear_cache)
             except ValueError as e:
                 controller.abort(400, e.args[0])
+            export_locations_safely()
 
-        @controller.require_permission(manage_locations, use_moderator=False)
-        def delete(self, session):
-            delete_locations(session)
+        @controller.require_permission(manage_locations, use_session=False, use_moderator=False)
+        def delete(self):
+            with sessionmaker.begin() as session:
+                delete_locations(session)
+            export_locations_safely()
 
     class UpdatedMarkResource(Resource):
         parser = RequestParser()
@@ -68,7 +74,13 @@ def setup(controller: MUBController = None) -> MUBController:
         def post(self, clear_cache: bool):
             mark_locations_updated(clear_cache)
 
+    class CacheStatsResource(Resource):
+        @controller.require_permission(manage_locations, use_session=False, use_moderator=False)
+        def get(self):
+            return {key_prefix: counter.dict() for key_prefix, counter in cache_counters.items()}
+
     controller.route("/")(CitiesControlResource)
     controller.route("/mark-updated/")(UpdatedMarkResource)
+    controller.route("/cache-stats/")(CacheStatsResource)
 
     return controller
@@ -8,14 +8,16 @@ from flask_restx import Resource
 from flask_restx.reqparse import RequestParser
 
 from common import ResourceController, sessionmaker
-from .locations_db import Place, County, Region
-from .locations_ini import locations_config
+from .locations_db import Place, County, Region, canonicalize
+from .locations_exp import CountyIndexModel, COUNTIES_FILENAME, REGION_FILENAME, find_export
+from .locations_ini import locations_config, cache_counters, CacheCounter
 
 
 def with_revalidate():
     def with_revalidate_wrapper(function):
         @wraps(function)
         def with_revalidate_inner(*args, **kwargs):
+            locations_config.refresh(current_app)
             if not current_app.config.get("NQ_DISABLE_REVALIDATION", False) \
                     and locations_config.compare_expiry(request.if_modified_since):
                 return Response(status=304)
@@ -30,6 +32,24 @@ def with_revalidate():
     return with_revalidate_wrapper
 
 
+def with_accel_redirect(filename: str, filename_key: str = None):
+    def with_accel_redirect_wrapper(function):
+        @wraps(function)
+        def with_accel_redirect_inner(*args, **kwargs):
+            location = find_export(current_app, filename if filename_key is None
+                                   else filename.format(kwargs[filename_key]))
+            if location is None:
+                return function(*args, **kwargs)
+
+            response = Response(mimetype="application/json")  # nginx keeps the upstream Content-Type
+            response.headers.add_header("X-Accel-Redirect", location)
+            return response
+
+        return with_accel_redirect_inner
+
+    return with_accel_redirect_wrapper
+
+
 def parse_search(controller):
     parser = RequestParser()
     parser.add_argument("search", required=True)
@@ -45,6 +65,11 @@ def parse_search(controller):
                 return response
             if Place.is_search_invalid(search):
                 return jsonify([])
+            search = canonicalize(search)
+            if len(search) == 0:
+                response = jsonify("Empty search")
+                response.status = 400
+                return response
             return function(*args, search=search, **kwargs)
 
         return parse_search_inner
@@ -53,6 +78,8 @@ def parse_search(controller):
 
 
 def with_caching(cache: Cache, key_prefix: str, cache_key: str = None):
+    counter = cache_counters.setdefault(key_prefix, CacheCounter())
+
     def with_caching_wrapper(function):
         @wraps(function)
         def with_caching_inner(*args, **kwargs):
@@ -60,8 +87,10 @@ def with_caching(cache: Cache, key_prefix: str, cache_key: str = None):
             if cache_key is not None:
                 key += str(kwargs[cache_key])
             if cache.has(key):
+                counter.hits += 1
                 return cache.get(key)
 
+            counter.misses += 1
             response = jsonify(function(*args, **kwargs))
             cache.set(key, response)
             return response
@@ -84,17 +113,9 @@ def setup(controller: ResourceController = None, search_cache=None, important_ca
         def get(self, session, search: str):
             return Place.get_all(session, search)
 
-    @County.BaseModel.include_context("session")
-    class CountyIndexModel(County.BaseModel):
-        regions: list[Place.RegionModel]
-
-        @classmethod
-        def callback_convert(cls, callback, orm_object: County, session=None, **_):
-            callback(regions=[Place.RegionModel.convert(reg)
-                              for reg in Place.get_regions_by_county(session, orm_object.id)])
-
     class CountiesTreeer(Resource):
         @with_revalidate()
+        @with_accel_redirect(COUNTIES_FILENAME)
         @with_caching(important_cache, "counties")
         @controller.with_begin
         @controller.marshal_list_with(CountyIndexModel)
@@ -103,6 +124,7 @@ def setup(controller: ResourceController = None, search_cache=None, important_ca
 
     class RegionsTreeer(Resource):
         @with_revalidate()
+        @with_accel_redirect(REGION_FILENAME, "region_id")
         @with_caching(important_cache, "region-", "region_id")
         @controller.with_begin
         @controller.database_searcher(Region, use_session=True, check_only=True)
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from json import loads
+from re import compile as compile_regex
+from typing import Iterable, Iterator
+
+from sqlalchemy import event, select
+from sqlalchemy.engine import Engine
+
+from .locations_db import Place, County, Region
+
+SQLITE_DETAIL = compile_regex(r"^(SCAN|SEARCH) (\w+)(?: AS \w+)?"
+                              r"(?: USING (?:(?:COVERING )?INDEX (\w+)|(INTEGER PRIMARY KEY)))?")
+SEQUENTIAL_SCANS = ("Seq Scan", "SCAN", "ALL")
+
+
+@dataclass()
+class PlanNode:
+    depth: int
+    node_type: str
+    relation: str = None
+    index: str = None
+    estimated_rows: float = None
+    actual_rows: float = None
+    time: float = None
+
+    @property
+    def is_sequential_scan(self) -> bool:
+        return self.node_type in SEQUENTIAL_SCANS and self.index is None \
+            and self.relation is not None and self.relation.startswith("nq_")
+
+
+@dataclass()
+class CapturedStatement:
+    label: str
+    connection: object
+    statement: str
+    parameters: object
+    executions: int = 1
+    plan: list[PlanNode] = field(default_factory=list)
+
+    @property
+    def compact_statement(self) -> str:
+        return " ".join(self.statement.split())
+
+
+@contextmanager
+def capture_statements(label: str, captured: dict[tuple[str, str], CapturedStatement]) -> Iterator[None]:
+    def before_cursor_execute(connection, _cursor, statement, parameters, _context, _executemany):
+        if (label, statement) in captured:
+            captured[label, statement].executions += 1
+        else:
+            captured[label, statement] = CapturedStatement(label, connection, statement, parameters)
+
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+
+
+def walk_postgresql_plan(plan: dict, depth: int = 0) -> Iterator[PlanNode]:
+    yield PlanNode(depth, plan["Node Type"], plan.get("Relation Name"), plan.get("Index Name"),
+                   plan.get("Plan Rows"), plan.get("Actual Rows"), plan.get("Actual Total Time"))
+    for child in plan.get("Plans", []):
+        yield from walk_postgresql_plan(child, depth + 1)
+
+
+def explain_statement(captured: CapturedStatement) -> list[PlanNode]:
+    connection = captured.connection
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        result = connection.exec_driver_sql("EXPLAIN (ANALYZE, FORMAT JSON) " + captured.statement,
+                                            captured.parameters).scalar()
+        if isinstance(result, str):
+            result = loads(result)
+        return list(walk_postgresql_plan(result[0]["Plan"]))
+
+    if dialect == "sqlite":
+        depths: dict[int, int] = {0: -1}
+        nodes: list[PlanNode] = []
+        for node_id, parent_id, _, detail in connection.exec_driver_sql(
+                "EXPLAIN QUERY PLAN " + captured.statement, captured.parameters).all():
+            depths[node_id] = depths.get(parent_id, -1) + 1
+            match = SQLITE_DETAIL.match(detail)
+            if match is None:
+                nodes.append(PlanNode(depths[node_id], detail))
+            else:
+                nodes.append(PlanNode(depths[node_id], match.group(1), match.group(2),
+                                      match.group(3) or match.group(4)))
+        return nodes
+
+    nodes: list[PlanNode] = []
+    for row in connection.exec_driver_sql("EXPLAIN " + captured.statement, captured.parameters).mappings():
+        if "table" in row and "type" in row:  # mysql & mariadb
+            nodes.append(PlanNode(0, row["type"], row["table"], row.get("key"), row.get("rows")))
+        else:
+            nodes.append(PlanNode(0, " ".join(str(value) for value in row.values())))
+    return nodes
+
+
+def collect_statements(session, search: str, strategies: Iterable[int], county_id: int = None,
+                       region_id: int = None) -> list[CapturedStatement]:
+    if county_id is None:
+        county_id = session.get_first(select(County.id).order_by(County.id))
+    if region_id is None:
+        region_id = session.get_first(select(Region.id).order_by(Region.id))
+
+    captured: dict[tuple[str, str], CapturedStatement] = {}
+    for strategy in strategies:
+        with capture_statements(f"Place.get_all({search!r}, strategy={strategy})", captured):
+            Place.get_all(session, search, strategy=strategy)
+    with capture_statements(f"Place.get_regions_by_county({county_id})", captured):
+        Place.get_regions_by_county(session, county_id)
+    with capture_statements(f"Place.get_most_populous({region_id})", captured):
+        Place.get_most_populous(session, region_id)
+
+    for statement in captured.values():
+        statement.plan = explain_statement(statement)
+    return list(captured.values())
+
+
+def format_value(value, pattern: str = "{:.0f}") -> str:
+    return "-" if value is None else pattern.format(value)
+
+
+def format_report(statements: list[CapturedStatement], timing: bool = True) -> Iterator[str]:
+    header = f"    {'node':40} {'relation':24} {'index':32} {'est rows':>10} {'act rows':>10}"
+    if timing:
+        header += f" {'time ms':>10}"
+
+    label, number, sequential_scans = None, 0, 0
+    for statement in statements:
+        if statement.label != label:
+            label, number = statement.label, 0
+            yield ""
+            yield f"== {label} =="
+        number += 1
+        yield f"#{number} (executed {statement.executions}x) {statement.compact_statement}"
+        yield f"    parameters: {statement.parameters!r}"
+        yield header
+        for node in statement.plan:
+            line = (f"    {'  ' * node.depth + node.node_type:40} {node.relation or '-':24} {node.index or '-':32} "
+                    f"{format_value(node.estimated_rows):>10} {format_value(node.actual_rows):>10}")
+            if timing:
+                line += f" {format_value(node.time, '{:.3f}'):>10}"
+            yield line.rstrip()
+        for node in statement.plan:
+            if node.is_sequential_scan:
+                sequential_scans += 1
+                yield f"    !! sequential scan on {node.relation}"
+
+    yield ""
+    yield f"Total: {len(statements)} statements, {sequential_scans} sequential scans on nq_* tables"